@@ -47,6 +47,13 @@ class Command(BaseCommand):
             'default': 5.0,
             'help': 'Sleep for this many seconds before checking for new tasks (if none were found) - default is 5',
         }),
+        (('--batch-size', ), {
+            'action': 'store',
+            'dest': 'batch_size',
+            'type': int,
+            'default': 20,
+            'help': 'Lock up to this many tasks with each check for new tasks - default is 20',
+        }),
         (('--queue', ), {
             'action': 'store',
             'dest': 'queue',
@@ -81,6 +88,7 @@ class Command(BaseCommand):
     def run(self, *args, **options):
         duration = options.get('duration', 0)
         sleep = options.get('sleep', 5.0)
+        batch_size = options.get('batch_size', 20)
         queue = options.get('queue', None)
         log_std = options.get('log_std', False)
         is_dev = options.get('dev', False)
@@ -97,19 +105,23 @@ class Command(BaseCommand):
 
         start_time = time.time()
 
-        while (duration <= 0) or (time.time() - start_time) <= duration:
-            if sig_manager.kill_now:
-                # shutting down gracefully
-                break
-
-            if not self._tasks.run_next_task(queue):
-                # there were no tasks in the queue, let's recover.
-                close_connection()
-                logger.debug('waiting for tasks')
-                time.sleep(sleep)
-            else:
-                # there were some tasks to process, let's check if there is more work to do after a little break.
-                time.sleep(random.uniform(sig_manager.time_to_wait[0], sig_manager.time_to_wait[1]))
+        try:
+            while (duration <= 0) or (time.time() - start_time) <= duration:
+                if sig_manager.kill_now:
+                    # shutting down gracefully
+                    break
+
+                if not self._tasks.run_next_task(queue, batch_size):
+                    # there were no tasks in the queue, let's recover.
+                    close_connection()
+                    logger.debug('waiting for tasks')
+                    time.sleep(sleep)
+                else:
+                    # there were some tasks to process, let's check if there is more work to do after a little break.
+                    time.sleep(random.uniform(sig_manager.time_to_wait[0], sig_manager.time_to_wait[1]))
+        finally:
+            # hand tasks locked ahead but not run back to the other workers
+            self._tasks.release_ready_tasks()
 
     def handle(self, *args, **options):
         is_dev = options.get('dev', False)
@@ -9,7 +9,7 @@ import traceback
 from io import StringIO
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import connections, models, transaction
 from django.db.models import Q
 from django.utils import timezone
 from six import python_2_unicode_compatible
@@ -44,11 +44,13 @@ class TaskManager(models.Manager):
     def created_by(self, creator):
         return self.get_queryset().created_by(creator)
 
-    def find_available(self, queue=None):
+    def find_available(self, queue=None, task_names=None):
         now = timezone.now()
         qs = self.unlocked(now)
         if queue:
             qs = qs.filter(queue=queue)
+        if task_names is not None:
+            qs = qs.filter(task_name__in=task_names)
         ready = qs.filter(run_at__lte=now, failed_at=None)
         _priority_ordering = '{}priority'.format(
             app_settings.BACKGROUND_TASK_PRIORITY_ORDERING)
@@ -72,6 +74,30 @@ class TaskManager(models.Manager):
         unlocked = Q(locked_by=None) | Q(locked_at__lt=expires_at)
         return qs.filter(unlocked)
 
+    def bulk_lock(self, ids, locked_by, now=None):
+        """
+        Lock all still unlocked tasks in `ids` for `locked_by` in one UPDATE.
+        :return: A list of the tasks actually locked, in the order of `ids`
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+        if now is None:
+            now = timezone.now()
+        using = self.db
+        with transaction.atomic(using=using):
+            qs = self.unlocked(now).filter(pk__in=ids)
+            if connections[using].features.has_select_for_update_skip_locked:
+                # don't wait on rows another worker is busy claiming
+                skip_locked = qs.select_for_update(skip_locked=True)
+                qs = self.get_queryset().filter(
+                    pk__in=list(skip_locked.values_list('pk', flat=True)))
+            updated = qs.update(locked_by=locked_by, locked_at=now)
+        if not updated:
+            return []
+        locked = self.get_queryset().filter(pk__in=ids, locked_by=locked_by).in_bulk()
+        return [locked[pk] for pk in ids if pk in locked]
+
     def locked(self, now):
         max_run_time = app_settings.BACKGROUND_TASK_MAX_RUN_TIME
         qs = self.get_queryset()
@@ -223,11 +249,12 @@ class Task(models.Model):
     def locked_by_pid_running(self):
         """
         Check if the locked_by process is still running.
+        `locked_by` is either "<pid>:<thread ident>" or, for older locks, "<pid>".
         """
         if self.locked_by:
             try:
                 # won't kill the process. kill is a bad named system call
-                os.kill(int(self.locked_by), 0)
+                os.kill(int(self.locked_by.split(':')[0]), 0)
                 return True
             except:
                 return False
@@ -458,11 +485,12 @@ class CompletedTask(models.Model):
     def locked_by_pid_running(self):
         """
         Check if the locked_by process is still running.
+        `locked_by` is either "<pid>:<thread ident>" or, for older locks, "<pid>".
         """
         if self.locked_by:
             try:
                 # won't kill the process. kill is a bad named system call
-                os.kill(int(self.locked_by), 0)
+                os.kill(int(self.locked_by.split(':')[0]), 0)
                 return True
             except:
                 return False
@@ -22,12 +22,21 @@ def reset_queries(**kwargs):
 task_started.connect(reset_queries)
 
 
+def close_obsolete_connections():
+    """
+    Close connections left unusable by an error or past CONN_MAX_AGE.
+    Connections inside a transaction of the caller are left alone.
+    """
+    for conn in connections.all():
+        if not conn.in_atomic_block:
+            conn.close_if_unusable_or_obsolete()
+
+
 # Register an event to reset transaction state and close connections past
 # their lifetime.
 def close_old_connections(**kwargs):
     if app_settings.BACKGROUND_TASK_RUN_ASYNC:
-        for conn in connections.all():
-            conn.close_if_unusable_or_obsolete()
+        close_obsolete_connections()
 
 
 task_started.connect(close_old_connections)
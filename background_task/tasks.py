@@ -1,80 +1,155 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import itertools
 import logging
 import os
 import sys
+import threading
+from collections import deque
 from datetime import datetime, timedelta
-from multiprocessing.pool import ThreadPool
 
 from django.db.utils import OperationalError
 from django.utils import timezone
 from six import python_2_unicode_compatible
 
 from background_task import signals
-from background_task.exceptions import BackgroundTaskError
 from background_task.models import Task
 from background_task.settings import app_settings
 
 logger = logging.getLogger(__name__)
 
+# bound once, bg_runner sends these for every task it runs
+_task_started_send = signals.task_started.send
+_task_finished_send = signals.task_finished.send
+
 
 def bg_runner(proxy_task, task=None, *args, **kwargs):
     """
     Executes the function attached to task. Used to enable threads.
     If a Task instance is provided, args and kwargs are ignored and retrieved from the Task itself.
+    Without a Task the call is transient: nothing is recorded in the database.
     """
-    signals.task_started.send(Task)
+    _task_started_send(Task)
     try:
-        func = getattr(proxy_task, 'task_function', None)
-        if isinstance(task, Task):
+        func = proxy_task.task_function
+        if task is not None:
             args, kwargs = task.params()
-        else:
-            task_name = getattr(proxy_task, 'name', None)
-            task_queue = getattr(proxy_task, 'queue', None)
-            task_qs = Task.objects.get_task(task_name=task_name, args=args, kwargs=kwargs)
-            if task_queue:
-                task_qs = task_qs.filter(queue=task_queue)
-            if task_qs:
-                task = task_qs[0]
-        if func is None:
-            raise BackgroundTaskError("Function is None, can't execute!")
         func(*args, **kwargs)
 
         if task:
             # task done, so can delete it
             task.increment_attempts()
             completed = task.create_completed_task()
-            signals.task_successful.send(sender=task.__class__, task_id=task.id, completed_task=completed)
+            signals.task_successful.send(Task, task_id=task.id, completed_task=completed)
             task.create_repetition()
             task.delete()
             logger.info('Ran task and deleting %s', task)
 
     except Exception as ex:
         t, e, traceback = sys.exc_info()
+        signals.close_obsolete_connections()
         if task:
             logger.error('Rescheduling %s', task, exc_info=(t, e, traceback))
             signals.task_error.send(sender=ex.__class__, task=task)
             task.reschedule(t, e, traceback)
         del traceback
-    signals.task_finished.send(Task)
+    _task_finished_send(Task)
+
+
+class _PoolWorker(threading.Thread):
+    """
+    A PoolRunner thread owning a local deque of jobs.
+
+    Jobs are appended to the right end. The owner takes the oldest job from
+    the left end of its own deque, idle workers steal from the right end of
+    their peers' deques.
+    """
+
+    def __init__(self, pool_runner, index):
+        super(_PoolWorker, self).__init__(name='background-task-worker-%d' % index)
+        self.daemon = True
+        self.jobs = deque()
+        self.event = threading.Event()
+        self.idle = False
+        self._pool_runner = pool_runner
+        self._index = index
+
+    def take(self):
+        try:
+            return self.jobs.popleft()
+        except IndexError:
+            pass
+        workers = self._pool_runner._pool_instance
+        count = len(workers)
+        for offset in range(1, count):
+            peer = workers[(self._index + offset) % count]
+            try:
+                return peer.jobs.pop()
+            except IndexError:
+                continue
+        return None
+
+    def run(self):
+        bg_runner = self._pool_runner._bg_runner
+        while True:
+            # Clear the event and flag ourselves idle *before* looking for
+            # work, so a job submitted after the sweep always wakes us up.
+            self.event.clear()
+            self.idle = True
+            job = self.take()
+            if job is None:
+                self.event.wait()
+                continue
+            self.idle = False
+            proxy_task, task, args, kwargs = job
+            try:
+                bg_runner(proxy_task, task, *args, **kwargs)
+            except Exception:
+                logger.exception('Unhandled error running %s', proxy_task)
+            finally:
+                self._pool_runner._slots.release()
 
 
 class PoolRunner:
+    # how many jobs per thread may be queued or running before run() blocks
+    max_inflight_per_thread = 4
+
     def __init__(self, bg_runner, num_processes):
         self._bg_runner = bg_runner
         self._num_processes = num_processes
+        self._counter = itertools.count()
+        self._slots = threading.BoundedSemaphore(num_processes * self.max_inflight_per_thread)
+        self._pool_lock = threading.Lock()
 
     _pool_instance = None
 
     @property
     def _pool(self):
-        if not self._pool_instance:
-            self._pool_instance = ThreadPool(processes=self._num_processes)
+        if self._pool_instance is None:
+            # double-checked, so concurrent first runs start a single pool
+            with self._pool_lock:
+                if self._pool_instance is None:
+                    workers = [_PoolWorker(self, index) for index in range(self._num_processes)]
+                    self._pool_instance = workers
+                    for worker in workers:
+                        worker.start()
         return self._pool_instance
 
     def run(self, proxy_task, task=None, *args, **kwargs):
-        self._pool.apply_async(func=self._bg_runner, args=(proxy_task, task) + tuple(args), kwds=kwargs)
+        workers = self._pool
+        # block the submitter while the workers are saturated
+        self._slots.acquire()
+        worker = workers[next(self._counter) % len(workers)]
+        worker.jobs.append((proxy_task, task, args, kwargs))
+        if worker.idle:
+            worker.event.set()
+            return
+        # the target is busy, wake up an idle peer to steal the job
+        for peer in workers:
+            if peer.idle:
+                peer.event.set()
+                break
 
     __call__ = run
 
@@ -82,6 +157,7 @@ class PoolRunner:
 class Tasks(object):
     def __init__(self):
         self._tasks = {}
+        self._task_names_set = frozenset()
         self._runner = DBTaskRunner()
         self._task_proxy_class = TaskProxy
         self._bg_runner = bg_runner
@@ -106,9 +182,17 @@ class Tasks(object):
             _name = name
             if not _name:
                 _name = '%s.%s' % (fn.__module__, fn.__name__)
+            _name = sys.intern(_name)
             proxy = self._task_proxy_class(_name, fn, schedule, queue,
                                            remove_existing_tasks, self._runner)
             self._tasks[_name] = proxy
+            self._task_names_set = frozenset(self._tasks)
+            # let callers holding the function skip the registry lookup,
+            # bound methods and builtins don't take attributes though
+            try:
+                fn._bg_proxy = proxy
+            except AttributeError:
+                pass
             return proxy
 
         if fn:
@@ -127,14 +211,23 @@ class Tasks(object):
             kwargs = {}
         else:
             task = None
-        proxy_task = self._tasks[task_name]
+        self.run_proxy(self._tasks[task_name], task, *args, **kwargs)
+
+    def run_proxy(self, proxy_task, task=None, *args, **kwargs):
+        """
+        Same as run_task, for callers already holding the TaskProxy
+        (e.g. via the decorated function's `_bg_proxy` attribute).
+        """
         if app_settings.BACKGROUND_TASK_RUN_ASYNC:
             self._pool_runner(proxy_task, task, *args, **kwargs)
         else:
             self._bg_runner(proxy_task, task, *args, **kwargs)
 
-    def run_next_task(self, queue=None):
-        return self._runner.run_next_task(self, queue)
+    def run_next_task(self, queue=None, batch_size=1):
+        return self._runner.run_next_task(self, queue, batch_size)
+
+    def release_ready_tasks(self):
+        return self._runner.release_ready_tasks()
 
 
 class TaskSchedule(object):
@@ -149,6 +242,8 @@ class TaskSchedule(object):
 
     @classmethod
     def create(self, schedule):
+        if schedule is None:
+            return TaskSchedule._EMPTY
         if isinstance(schedule, TaskSchedule):
             return schedule
         priority = None
@@ -166,23 +261,27 @@ class TaskSchedule(object):
         return TaskSchedule(run_at=run_at, priority=priority, action=action)
 
     def merge(self, schedule):
-        params = {}
-        for name in ['run_at', 'priority', 'action']:
-            attr_name = '_%s' % name
-            value = getattr(self, attr_name, None)
-            if value is None:
-                params[name] = getattr(schedule, attr_name, None)
-            else:
-                params[name] = value
-        return TaskSchedule(**params)
+        if self is TaskSchedule._EMPTY:
+            return schedule
+        if schedule is TaskSchedule._EMPTY:
+            return self
+        run_at = self._run_at if self._run_at is not None else schedule._run_at
+        priority = self._priority if self._priority is not None else schedule._priority
+        action = self._action if self._action is not None else schedule._action
+        if run_at is self._run_at and priority is self._priority and action is self._action:
+            # nothing taken from schedule, self is the merged result
+            return self
+        return TaskSchedule(run_at=run_at, priority=priority, action=action)
 
     @property
     def run_at(self):
-        run_at = self._run_at or timezone.now()
+        run_at = self._run_at
+        if run_at is None:
+            return timezone.now()
         if isinstance(run_at, int):
-            run_at = timezone.now() + timedelta(seconds=run_at)
+            return timezone.now() + timedelta(seconds=run_at)
         if isinstance(run_at, timedelta):
-            run_at = timezone.now() + run_at
+            return timezone.now() + run_at
         return run_at
 
     @property
@@ -203,6 +302,10 @@ class TaskSchedule(object):
             and self._action == other._action
 
 
+# shared by all schedules created from None, never mutated
+TaskSchedule._EMPTY = TaskSchedule()
+
+
 class DBTaskRunner(object):
     '''
     Encapsulate the model related logic in here, in case
@@ -210,7 +313,21 @@ class DBTaskRunner(object):
     '''
 
     def __init__(self):
-        self.worker_name = str(os.getpid())
+        self._worker_names = {}
+        # tasks locked by a previous poll but not run yet, by queue
+        self._ready = {}
+
+    @property
+    def worker_name(self):
+        '''
+        Identifies the locking process and thread. Computed on access so a
+        process forked after import doesn't use its parent's pid.
+        '''
+        key = (os.getpid(), threading.get_ident())
+        worker_name = self._worker_names.get(key)
+        if worker_name is None:
+            worker_name = self._worker_names[key] = '%d:%d' % key
+        return worker_name
 
     def schedule(self, task_name, args, kwargs, run_at=None,
                  priority=0, action=TaskSchedule.SCHEDULE, queue=None,
@@ -232,32 +349,68 @@ class DBTaskRunner(object):
                 if updated:
                     return
             elif action == TaskSchedule.CHECK_EXISTING:
-                if existing.count():
+                if existing.exists():
                     return
 
         task.save()
         signals.task_created.send(sender=self.__class__, task=task)
         return task
 
-    def get_task_to_run(self, tasks, queue=None):
+    def get_task_to_run(self, tasks, queue=None, batch_size=1):
         try:
-            available_tasks = [task for task in Task.objects.find_available(queue)
-                               if task.task_name in tasks._tasks][:5]
-            for task in available_tasks:
-                # try to lock task
-                locked_task = task.lock(self.worker_name)
-                if locked_task:
-                    return locked_task
-            return None
+            task = self._pop_ready(queue)
+            if task is None:
+                task = self._refill(tasks, queue, batch_size)
         except OperationalError:
             logger.warning('Failed to retrieve tasks. Database unreachable.')
+            return None
+        return task
+
+    def _refill(self, tasks, queue=None, batch_size=1):
+        available_tasks = Task.objects.find_available(queue, task_names=tasks._task_names_set)
+        task_ids = list(available_tasks.values_list('pk', flat=True)[:batch_size])
+        # lock all of them at once, later calls only renew the lock of the next one
+        locked_tasks = Task.objects.bulk_lock(task_ids, self.worker_name)
+        if not locked_tasks:
+            return None
+        self._ready.setdefault(queue, deque()).extend(locked_tasks[1:])
+        return locked_tasks[0]
+
+    def _pop_ready(self, queue=None):
+        ready = self._ready.get(queue)
+        while ready:
+            task = ready.popleft()
+            # restart the lock, MAX_RUN_TIME counts from when the task is run.
+            # Nothing updated: the task is gone or another worker took it over
+            # after the lock expired.
+            now = timezone.now()
+            if Task.objects.filter(pk=task.pk, locked_by=self.worker_name).update(locked_at=now):
+                task.locked_at = now
+                return task
+        return None
+
+    def release_ready_tasks(self):
+        '''
+        Unlock the tasks locked ahead by get_task_to_run but not run yet,
+        so other workers don't have to wait for MAX_RUN_TIME to pick them up
+        '''
+        task_ids = [task.pk for ready in self._ready.values() for task in ready]
+        self._ready.clear()
+        if not task_ids:
+            return 0
+        try:
+            return Task.objects.filter(pk__in=task_ids, locked_by=self.worker_name) \
+                .update(locked_by=None, locked_at=None)
+        except OperationalError:
+            logger.warning('Failed to unlock tasks. Database unreachable.')
+            return 0
 
     def run_task(self, tasks, task):
         logger.info('Running %s', task)
         tasks.run_task(task)
 
-    def run_next_task(self, tasks, queue=None):
-        task = self.get_task_to_run(tasks, queue)
+    def run_next_task(self, tasks, queue=None, batch_size=1):
+        task = self.get_task_to_run(tasks, queue, batch_size)
         if task:
             self.run_task(tasks, task)
             return True
@@ -277,7 +430,10 @@ class TaskProxy(object):
 
     def __call__(self, *args, **kwargs):
         schedule = kwargs.pop('schedule', None)
-        schedule = TaskSchedule.create(schedule).merge(self.schedule)
+        if schedule is None:
+            schedule = self.schedule
+        else:
+            schedule = TaskSchedule.create(schedule).merge(self.schedule)
         run_at = schedule.run_at
         priority = kwargs.pop('priority', schedule.priority)
         action = schedule.action
@@ -304,15 +460,17 @@ def autodiscover():
     """
     Autodiscover tasks.py files in much the same way as admin app
     """
+    from importlib.util import find_spec
     from django.conf import settings
     from django.utils.module_loading import import_module
 
-    installed_apps = settings.INSTALLED_APPS.copy()
-    if 'report_builder' in installed_apps:
-        installed_apps.remove('report_builder')
+    installed_apps = tuple(app for app in settings.INSTALLED_APPS if app != 'report_builder')
 
     for app in installed_apps:
+        module_name = "%s.tasks" % app
         try:
-            import_module("%s.tasks" % app)
+            # probe first, so apps without tasks module don't raise
+            if find_spec(module_name) is not None:
+                import_module(module_name)
         except ImportError:
             continue
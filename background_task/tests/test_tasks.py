@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import os
+import threading
 import time
 from datetime import timedelta, datetime
 from mock import patch, Mock
@@ -11,10 +13,12 @@ from django.conf import settings
 from django.utils import timezone
 
 from background_task.exceptions import InvalidTaskError
-from background_task.tasks import tasks, TaskSchedule, TaskProxy
+from background_task.tasks import tasks, TaskSchedule, TaskProxy, PoolRunner, autodiscover
+from background_task.management.commands.process_tasks import Command
 from background_task.models import Task
 from background_task.models import CompletedTask
 from background_task import background
+from background_task import signals
 from background_task.settings import app_settings
 
 _recorded = []
@@ -51,6 +55,10 @@ def empty_task():
     pass
 
 
+def any_args_task(*arg, **kw):
+    pass
+
+
 def record_task(*arg, **kw):
     _recorded.append((arg, kw))
 
@@ -83,13 +91,34 @@ class TestBackgroundDecorator(TransactionTestCase):
         proxy = tasks.background(name='mytask')(empty_task)
         self.assertEqual(proxy.name, 'mytask')
 
+    def test_task_names(self):
+        self.assertNotIn('test_task_names', tasks._task_names_set)
+
+        tasks.background(name='test_task_names')(empty_task)
+        self.assertIn('test_task_names', tasks._task_names_set)
+        self.assertEqual(frozenset(tasks._tasks), tasks._task_names_set)
+
     def test_task_function(self):
         proxy = tasks.background()(empty_task)
         self.assertEqual(proxy.task_function, empty_task)
+        self.assertIs(empty_task._bg_proxy, proxy)
 
         proxy = tasks.background()(record_task)
         self.assertEqual(proxy.task_function, record_task)
 
+    def test_bound_method_and_builtin(self):
+        class Recorder(object):
+            def record(self):
+                pass
+
+        recorder = Recorder()
+        proxy = tasks.background(name='bound_method')(recorder.record)
+        self.assertEqual(proxy.task_function, recorder.record)
+        self.assertIs(tasks._tasks['bound_method'], proxy)
+
+        proxy = tasks.background(name='builtin')(len)
+        self.assertIs(proxy.task_function, len)
+
     def test_default_schedule(self):
         proxy = tasks.background()(empty_task)
         self.assertEqual(TaskSchedule(), proxy.schedule)
@@ -125,6 +154,21 @@ class TestBackgroundDecorator(TransactionTestCase):
         self.assertEqual(CompletedTask.objects.count(), ct, 'Completed task was created')
 
 
+class TestAutodiscover(TransactionTestCase):
+
+    def test_skips_apps_without_tasks_module(self):
+        installed_apps = [
+            'django.contrib.contenttypes',
+            'background_task.apps.BackgroundTasksAppConfig',
+            'not_an_installed_module',
+            'background_task',
+        ]
+        with patch.object(settings, 'INSTALLED_APPS', installed_apps), \
+                patch('django.utils.module_loading.import_module') as import_module:
+            autodiscover()
+        import_module.assert_called_once_with('background_task.tasks')
+
+
 class TestTaskProxy(TransactionTestCase):
 
     def setUp(self):
@@ -141,6 +185,115 @@ class TestTaskProxy(TransactionTestCase):
         run_task(self.proxy.name, [], {'kw': 1})
         self.assertEqual(((), {'kw': 1}), _recorded.pop())
 
+    def test_run_task_by_name_is_transient(self):
+        task = self.proxy('hi')
+        run_task(self.proxy.name, ['hi'], {})
+        self.assertEqual((('hi',), {}), _recorded.pop())
+        # only running the Task itself completes it
+        self.assertTrue(Task.objects.filter(pk=task.pk).exists())
+        self.assertEqual(0, CompletedTask.objects.count())
+
+        run_task(task)
+        self.assertEqual((('hi',), {}), _recorded.pop())
+        self.assertFalse(Task.objects.filter(pk=task.pk).exists())
+        self.assertEqual(1, CompletedTask.objects.count())
+
+    def test_run_proxy(self):
+        tasks.run_proxy(record_task._bg_proxy, None, 'hi', kw=1)
+        if app_settings.BACKGROUND_TASK_RUN_ASYNC:
+            time.sleep(1)
+        self.assertEqual((('hi',), {'kw': 1}), _recorded.pop())
+
+
+class TestPoolRunner(TransactionTestCase):
+
+    def test_runs_all_jobs(self):
+        done = []
+        finished = threading.Event()
+
+        def runner(proxy_task, task=None, *args, **kwargs):
+            done.append((proxy_task, task, args, kwargs))
+            if len(done) == 20:
+                finished.set()
+
+        pool_runner = PoolRunner(runner, 4)
+        for i in range(20):
+            pool_runner(i, None, 'arg', kw=i)
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(sorted(job[0] for job in done), list(range(20)))
+        self.assertEqual(done[0][2:], (('arg',), {'kw': done[0][0]}))
+
+    def test_idle_worker_steals_from_busy_worker(self):
+        release = threading.Event()
+        blocking = threading.Event()
+        stolen = threading.Event()
+        threads = {}
+
+        def runner(proxy_task, task=None, *args, **kwargs):
+            threads[proxy_task] = threading.current_thread()
+            if proxy_task == 'block':
+                blocking.set()
+                release.wait(5)
+            elif proxy_task == 'steal':
+                stolen.set()
+
+        pool_runner = PoolRunner(runner, 2)
+        pool_runner('block')
+        # wait until a worker is busy with the blocking job
+        self.assertTrue(blocking.wait(5))
+        # round robin hands the next job to the second worker, the third
+        # one lands on the busy first worker and must be stolen
+        pool_runner('other')
+        pool_runner('steal')
+        try:
+            self.assertTrue(stolen.wait(5))
+            self.assertIsNot(threads['block'], threads['steal'])
+        finally:
+            release.set()
+
+    def test_pool_created_once(self):
+        pool_runner = PoolRunner(Mock(), 2)
+        barrier = threading.Barrier(8)
+        pools = []
+
+        def get_pool():
+            barrier.wait()
+            pools.append(pool_runner._pool)
+
+        threads = [threading.Thread(target=get_pool) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(8, len(pools))
+        for pool in pools:
+            self.assertIs(pools[0], pool)
+        self.assertEqual(2, len(pools[0]))
+
+    def test_run_blocks_when_saturated(self):
+        release = threading.Event()
+        submitted = threading.Event()
+
+        def runner(proxy_task, task=None, *args, **kwargs):
+            release.wait(5)
+
+        pool_runner = PoolRunner(runner, 1)
+        for i in range(PoolRunner.max_inflight_per_thread):
+            pool_runner(i)
+
+        def submit():
+            pool_runner('one too many')
+            submitted.set()
+
+        submitter = threading.Thread(target=submit)
+        submitter.start()
+        try:
+            self.assertFalse(submitted.wait(0.2))
+        finally:
+            release.set()
+        self.assertTrue(submitted.wait(5))
+        submitter.join()
+
 
 class TestTaskSchedule(TransactionTestCase):
 
@@ -224,6 +377,18 @@ class TestTaskSchedule(TransactionTestCase):
         self.assertEqual(2, schedule.priority)
         self.assertEqual(action, schedule.action)
 
+    def test_merge_empty(self):
+        default = TaskSchedule(run_at=10, priority=2)
+        empty = TaskSchedule.create(None)
+        self.assertIs(empty, TaskSchedule.create(None))
+        self.assertEqual(TaskSchedule(), empty)
+        self.assertIs(default, empty.merge(default))
+        self.assertIs(default, default.merge(empty))
+
+    def test_merge_populated(self):
+        schedule = TaskSchedule(run_at=20, priority=1, action=TaskSchedule.CHECK_EXISTING)
+        self.assertIs(schedule, schedule.merge(TaskSchedule(run_at=10, priority=2)))
+
     def test_repr(self):
         self.assertEqual('TaskSchedule(run_at=10, priority=0)',
                             repr(TaskSchedule(run_at=10, priority=0)))
@@ -301,6 +466,23 @@ class TestTaskRunner(TransactionTestCase):
     def setUp(self):
         super(TestTaskRunner, self).setUp()
         self.runner = tasks._runner
+        tasks.background(name='mytask')(empty_task)
+
+    def tearDown(self):
+        # like process_tasks on exit, unlock what the runner locked ahead
+        self.runner.release_ready_tasks()
+        super(TestTaskRunner, self).tearDown()
+
+    def test_worker_name(self):
+        worker_name = self.runner.worker_name
+        self.assertIs(worker_name, self.runner.worker_name)
+        self.assertEqual('%d:%d' % (os.getpid(), threading.get_ident()), worker_name)
+
+        other_names = []
+        thread = threading.Thread(target=lambda: other_names.append(self.runner.worker_name))
+        thread.start()
+        thread.join()
+        self.assertNotEqual(worker_name, other_names[0])
 
     def test_get_task_to_run_no_tasks(self):
         self.assertFalse(self.runner.get_task_to_run(tasks))
@@ -318,9 +500,126 @@ class TestTaskRunner(TransactionTestCase):
         self.assertFalse(locked_task.locked_at is None)
         self.assertEqual('mytask', locked_task.task_name)
 
+    @override_settings(BACKGROUND_TASK_ASYNC_THREADS=4)
+    def test_get_task_to_run_prefetches_locked_tasks(self):
+        first = Task.objects.new_task('mytask', [1], {}, priority=2)
+        first.save()
+        second = Task.objects.new_task('mytask', [2], {}, priority=1)
+        second.save()
+
+        locked_task = self.runner.get_task_to_run(tasks, batch_size=2)
+        self.assertEqual(first.pk, locked_task.pk)
+        # both tasks were locked by the single poll
+        self.assertEqual(2, Task.objects.filter(locked_by=self.runner.worker_name).count())
+
+        # no poll, only the lock of the prefetched task is renewed
+        with self.assertNumQueries(1):
+            locked_task = self.runner.get_task_to_run(tasks)
+        self.assertEqual(second.pk, locked_task.pk)
+        self.assertEqual(self.runner.worker_name, locked_task.locked_by)
+
+    @override_settings(BACKGROUND_TASK_ASYNC_THREADS=30)
+    def test_get_task_to_run_locks_one_batch_per_poll(self):
+        batch_size = 20
+        for i in range(batch_size + 1):
+            Task.objects.new_task('mytask', [i], {}).save()
+
+        self.assertTrue(self.runner.get_task_to_run(tasks, batch_size=batch_size))
+        self.assertEqual(batch_size,
+                         Task.objects.filter(locked_by=self.runner.worker_name).count())
+        with self.assertNumQueries(batch_size - 1):
+            for i in range(batch_size - 1):
+                self.assertTrue(self.runner.get_task_to_run(tasks, batch_size=batch_size))
+        # the local batch is drained, the next call polls again
+        self.assertTrue(self.runner.get_task_to_run(tasks, batch_size=batch_size))
+        self.assertIsNone(self.runner.get_task_to_run(tasks, batch_size=batch_size))
+
+    @override_settings(BACKGROUND_TASK_ASYNC_THREADS=4)
+    def test_get_task_to_run_skips_tasks_taken_over(self):
+        Task.objects.new_task('mytask', [1], {}, priority=2).save()
+        Task.objects.new_task('mytask', [2], {}, priority=1).save()
+        self.runner.get_task_to_run(tasks, batch_size=2)
+
+        # the lock of the remaining ready task expired and another worker took it
+        ready_task = self.runner._ready[None][0]
+        Task.objects.filter(pk=ready_task.pk).update(locked_by='other', locked_at=timezone.now())
+
+        self.assertIsNone(self.runner.get_task_to_run(tasks))
+        self.assertEqual(0, len(self.runner._ready[None]))
+        self.assertEqual('other', Task.objects.get(pk=ready_task.pk).locked_by)
+
+    @override_settings(BACKGROUND_TASK_ASYNC_THREADS=4)
+    def test_get_task_to_run_renews_lock_of_prefetched_task(self):
+        Task.objects.new_task('mytask', [1], {}, priority=2).save()
+        Task.objects.new_task('mytask', [2], {}, priority=1).save()
+        self.runner.get_task_to_run(tasks, batch_size=2)
+
+        # the lock of the remaining ready task is about to expire
+        ready_task = self.runner._ready[None][0]
+        near_expiry = timezone.now() - timedelta(seconds=(app_settings.BACKGROUND_TASK_MAX_RUN_TIME - 1))
+        Task.objects.filter(pk=ready_task.pk).update(locked_at=near_expiry)
+
+        before = timezone.now()
+        locked_task = self.runner.get_task_to_run(tasks)
+        self.assertEqual(ready_task.pk, locked_task.pk)
+        self.assertTrue(locked_task.locked_at >= before)
+        self.assertEqual(locked_task.locked_at, Task.objects.get(pk=ready_task.pk).locked_at)
+        # other workers still see it locked once the poll time lock would have expired
+        later = timezone.now() + timedelta(seconds=2)
+        self.assertFalse(Task.objects.unlocked(later).filter(pk=ready_task.pk).exists())
+
+    @override_settings(BACKGROUND_TASK_ASYNC_THREADS=4)
+    def test_release_ready_tasks(self):
+        first = Task.objects.new_task('mytask', [1], {}, priority=2)
+        first.save()
+        second = Task.objects.new_task('mytask', [2], {}, priority=1)
+        second.save()
+        locked_task = self.runner.get_task_to_run(tasks, batch_size=2)
+        self.assertEqual(first.pk, locked_task.pk)
+
+        self.assertEqual(1, self.runner.release_ready_tasks())
+        self.assertEqual({}, self.runner._ready)
+        # the task handed out stays locked, the one locked ahead is free
+        self.assertEqual(self.runner.worker_name, Task.objects.get(pk=first.pk).locked_by)
+        second = Task.objects.get(pk=second.pk)
+        self.assertIsNone(second.locked_by)
+        self.assertIsNone(second.locked_at)
+        self.assertEqual(0, self.runner.release_ready_tasks())
+
+    @override_settings(BACKGROUND_TASK_ASYNC_THREADS=10)
+    def test_run_next_task_locks_ahead_only_when_asked(self):
+        tasks.background(name='mytask')(any_args_task)
+        for i in range(5):
+            Task.objects.new_task('mytask', [i], {}).save()
+        self.assertTrue(run_next_task())
+        self.assertEqual(0, Task.objects.filter(locked_by__isnull=False).count())
+        self.assertEqual(0, tasks.release_ready_tasks())
+
+        self.assertTrue(tasks.run_next_task(batch_size=2))
+        if app_settings.BACKGROUND_TASK_RUN_ASYNC:
+            time.sleep(1)
+        self.assertEqual(1, Task.objects.filter(locked_by__isnull=False).count())
+        self.assertEqual(1, tasks.release_ready_tasks())
+        self.assertEqual(3, Task.objects.count())
+        self.assertEqual(0, Task.objects.filter(locked_by__isnull=False).count())
+
+    def test_get_task_to_run_skips_unregistered_tasks(self):
+        task = Task.objects.new_task('not_registered_task', [], {})
+        task.save()
+        self.assertIsNone(self.runner.get_task_to_run(tasks))
+        self.assertIsNone(Task.objects.get(pk=task.pk).locked_by)
+
 
 class TestTaskModel(TransactionTestCase):
 
+    def test_locked_by_pid_running(self):
+        task = Task.objects.new_task('mytask')
+        self.assertIsNone(task.locked_by_pid_running())
+        task.locked_by = tasks._runner.worker_name
+        self.assertTrue(task.locked_by_pid_running())
+        task.locked_by = str(os.getpid())
+        self.assertTrue(task.locked_by_pid_running())
+
     def test_lock_uncontested(self):
         task = Task.objects.new_task('mytask')
         task.save()
@@ -341,6 +640,25 @@ class TestTaskModel(TransactionTestCase):
 
         self.assertTrue(task.lock('otherlock') is None)
 
+    def test_bulk_lock(self):
+        first = Task.objects.new_task('mytask', [1])
+        first.save()
+        second = Task.objects.new_task('mytask', [2])
+        second.save()
+        third = Task.objects.new_task('mytask', [3])
+        third.save()
+        third.lock('otherlock')
+
+        locked = Task.objects.bulk_lock([second.pk, first.pk, third.pk], 'mylock')
+        self.assertEqual([second.pk, first.pk], [task.pk for task in locked])
+        for task in locked:
+            self.assertEqual('mylock', task.locked_by)
+            self.assertFalse(task.locked_at is None)
+        self.assertEqual('otherlock', Task.objects.get(pk=third.pk).locked_by)
+
+        self.assertEqual([], Task.objects.bulk_lock([first.pk], 'otherlock'))
+        self.assertEqual([], Task.objects.bulk_lock([], 'otherlock'))
+
     def test_lock_expired(self):
         task = Task.objects.new_task('mytask')
         task.save()
@@ -597,6 +915,87 @@ class TestTasks(TransactionTestCase):
         self.assertEqual(task.creator, user)
 
 
+class SignalsTestCase(TransactionTestCase):
+
+    def setUp(self):
+        @tasks.background(name='signals_task')
+        def signals_task(fail=False):
+            if fail:
+                raise RuntimeError('failed')
+        self.signals_task = signals_task
+
+    def test_successful_signal(self):
+        received = []
+
+        def receiver(sender, task_id, completed_task, **kwargs):
+            received.append((task_id, completed_task))
+
+        signals.task_successful.connect(receiver)
+        try:
+            task = self.signals_task()
+            run_next_task()
+        finally:
+            signals.task_successful.disconnect(receiver)
+        self.assertEqual(1, len(received))
+        self.assertEqual(task.id, received[0][0])
+        self.assertEqual(CompletedTask.objects.get(), received[0][1])
+
+    def test_error_signal(self):
+        received = []
+
+        def receiver(sender, task, **kwargs):
+            received.append((sender, task.pk))
+
+        signals.task_error.connect(receiver)
+        try:
+            task = self.signals_task(fail=True)
+            run_next_task()
+        finally:
+            signals.task_error.disconnect(receiver)
+        self.assertEqual([(RuntimeError, task.pk)], received)
+
+    def test_no_listeners(self):
+        self.assertFalse(signals.task_successful.has_listeners(Task))
+        self.signals_task()
+        self.assertTrue(run_next_task())
+        self.assertEqual(1, CompletedTask.objects.count())
+
+
+@override_settings(BACKGROUND_TASK_ASYNC_THREADS=4)
+class ProcessTasksCommandTestCase(TransactionTestCase):
+
+    def setUp(self):
+        super(ProcessTasksCommandTestCase, self).setUp()
+        tasks.background(name='mytask')(any_args_task)
+        for i in range(3):
+            Task.objects.new_task('mytask', [i], {}).save()
+        self.command = Command()
+        self.command.sig_manager = Mock(kill_now=False, time_to_wait=[0, 0])
+
+    def test_kill_now_releases_ready_tasks(self):
+        self.assertTrue(tasks._runner.get_task_to_run(tasks, batch_size=2))
+        self.command.sig_manager.kill_now = True
+        self.command.run(sleep=0)
+        self.assertEqual(1, Task.objects.filter(locked_by__isnull=False).count())
+
+    def test_duration_releases_ready_tasks(self):
+        with patch('background_task.management.commands.process_tasks.time') as mock_time:
+            # start, one loop iteration, then past the duration
+            mock_time.time.side_effect = [0, 0, 10]
+            self.command.run(duration=1, sleep=0)
+        if app_settings.BACKGROUND_TASK_RUN_ASYNC:
+            time.sleep(1)
+        self.assertEqual(2, Task.objects.count())
+        self.assertEqual(0, Task.objects.filter(locked_by__isnull=False).count())
+
+    def test_error_releases_ready_tasks(self):
+        with patch.object(tasks._runner, 'run_task', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.command.run(sleep=0)
+        self.assertEqual(1, Task.objects.filter(locked_by__isnull=False).count())
+        self.assertEqual({}, tasks._runner._ready)
+
+
 class MaxAttemptsTestCase(TransactionTestCase):
 
     def setUp(self):
@@ -735,6 +1134,21 @@ class RepetitionTestCase(TransactionTestCase):
         self.assertEqual((new_task.run_at - old_task.run_at), timedelta(hours=1))
         self.assertEqual(new_task.repeat_until, old_task.repeat_until)
 
+    def test_repeat_ignores_mutated_arguments(self):
+        @tasks.background(name='mutating_task')
+        def mutating_task(d, items):
+            d['n'] += 1
+            items.append('x')
+
+        old_task = mutating_task({'n': 0}, [], repeat=Task.HOURLY)
+        run_next_task()
+
+        new_task = Task.objects.get(repeat=Task.HOURLY)
+        self.assertNotEqual(new_task.id, old_task.id)
+        self.assertEqual(old_task.task_params, new_task.task_params)
+        self.assertEqual(old_task.task_hash, new_task.task_hash)
+        self.assertEqual(([{'n': 0}, []], {}), new_task.params())
+
     def test_repetition_in_future(self):
         repeat_until = timezone.now() + timedelta(weeks=1)
         old_task = self.my_task(